@@ -0,0 +1,19 @@
+from numba import njit
+
+
+@njit(cache=True)
+def strict_subset_pairs(masks):
+    """
+    Returns a list of index pairs (i, j) such that the cells of sentence j,
+    given as bitmasks in the uint64 array `masks`, are a strict subset
+    of the cells of sentence i.
+    """
+    pairs = []
+    n = len(masks)
+    for i in range(n):
+        a = masks[i]
+        for j in range(n):
+            b = masks[j]
+            if b & a == b and b != a:
+                pairs.append((i, j))
+    return pairs
@@ -0,0 +1,66 @@
+from pysat.card import CardEnc, EncType
+from pysat.solvers import Glucose4
+
+
+class SatKnowledge():
+    """
+    Incremental SAT encoding of what the AI knows about a board.
+    Cell (i, j) is the variable `i * width + j + 1`, true when the cell
+    is a mine, and every sentence is added as a cardinality constraint
+    `sum(cells) == count`. Clauses are only ever added, so the solver
+    keeps what it learned from one move to the next.
+    """
+
+    def __init__(self, height, width):
+        self.width = width
+        self.top_id = height * width
+        self.solver = Glucose4()
+
+    def var(self, cell):
+        return cell[0] * self.width + cell[1] + 1
+
+    def add_sentence(self, cells, count):
+        """
+        Adds the constraint that exactly `count` of `cells` are mines.
+        """
+        if not cells:
+            return
+        lits = [self.var(cell) for cell in cells]
+        cnf = CardEnc.equals(lits=lits, bound=count, top_id=self.top_id, encoding=EncType.seqcounter)
+        self.top_id = max(self.top_id, cnf.nv)
+        self.solver.append_formula(cnf.clauses)
+
+    def add_mine(self, cell):
+        self.solver.add_clause([self.var(cell)])
+
+    def add_safe(self, cell):
+        self.solver.add_clause([-self.var(cell)])
+
+    def forced(self, cells):
+        """
+        Returns a list of (cell, is_mine) pairs for the cells in `cells`
+        whose value follows from the constraints. A cell is forced when the
+        solver cannot find a model that flips the value it has in a known
+        model; every model found on the way rules out more cells at once.
+        """
+        if not cells or not self.solver.solve():
+            return []
+
+        # Value of every cell that has not yet been seen flipped in a model
+        model = self.solver.get_model()
+        pending = {cell: model[self.var(cell) - 1] > 0 for cell in cells}
+
+        forced = []
+        for cell in cells:
+            if cell not in pending:
+                continue
+            is_mine = pending.pop(cell)
+            var = self.var(cell)
+            if self.solver.solve(assumptions=[-var if is_mine else var]):
+                model = self.solver.get_model()
+                for other, value in list(pending.items()):
+                    if (model[self.var(other) - 1] > 0) != value:
+                        del pending[other]
+            else:
+                forced.append((cell, is_mine))
+        return forced
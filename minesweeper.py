@@ -1,5 +1,32 @@
 import itertools
+import logging
 import random
+from collections import deque
+
+import numpy as np
+
+from _infer import strict_subset_pairs
+from _sat import SatKnowledge
+
+log = logging.getLogger(__name__)
+
+
+def neighbor_table(height, width):
+    """
+    Returns a dict mapping every cell of a `height` x `width` board
+    to the tuple of cells within one row and column of it,
+    not including the cell itself.
+    """
+    return {
+        (i, j): tuple(
+            (ni, nj)
+            for ni in range(max(0, i - 1), min(height, i + 2))
+            for nj in range(max(0, j - 1), min(width, j + 2))
+            if (ni, nj) != (i, j)
+        )
+        for i in range(height)
+        for j in range(width)
+    }
 
 
 class Minesweeper():
@@ -14,21 +41,18 @@ class Minesweeper():
         self.width = width
         self.mines = set()
 
-        # Initialize an empty field with no mines
-        self.board = []
-        for i in range(self.height):
-            row = []
-            for j in range(self.width):
-                row.append(False)
-            self.board.append(row)
+        # Initialize an empty field with no mines, stored row by row
+        # so cell (i, j) lives at index i * width + j
+        self.board = bytearray(height * width)
 
         # Add mines randomly
-        while len(self.mines) != mines:
-            i = random.randrange(height)
-            j = random.randrange(width)
-            if not self.board[i][j]:
-                self.mines.add((i, j))
-                self.board[i][j] = True
+        flat = random.sample(range(height * width), mines)
+        self.mines = {(k // width, k % width) for k in flat}
+        for k in flat:
+            self.board[k] = 1
+
+        # Cells around every cell of the board
+        self.neighbors = neighbor_table(height, width)
 
         # At first, player has found no mines
         self.mines_found = set()
@@ -41,7 +65,7 @@ class Minesweeper():
         for i in range(self.height):
             print("--" * self.width + "-")
             for j in range(self.width):
-                if self.board[i][j]:
+                if self.board[i * self.width + j]:
                     print("|X", end="")
                 else:
                     print("| ", end="")
@@ -50,7 +74,7 @@ class Minesweeper():
 
     def is_mine(self, cell):
         i, j = cell
-        return self.board[i][j]
+        return bool(self.board[i * self.width + j])
 
     def nearby_mines(self, cell):
         """
@@ -58,24 +82,7 @@ class Minesweeper():
         within one row and column of a given cell,
         not including the cell itself.
         """
-
-        # Keep count of nearby mines
-        count = 0
-
-        # Loop over all cells within one row and column
-        for i in range(cell[0] - 1, cell[0] + 2):
-            for j in range(cell[1] - 1, cell[1] + 2):
-
-                # Ignore the cell itself
-                if (i, j) == cell:
-                    continue
-
-                # Update count if cell in bounds and is mine
-                if 0 <= i < self.height and 0 <= j < self.width:
-                    if self.board[i][j]:
-                        count += 1
-
-        return count
+        return sum(self.board[i * self.width + j] for i, j in self.neighbors[cell])
 
     def won(self):
         """
@@ -89,18 +96,37 @@ class Sentence():
     Logical statement about a Minesweeper game
     A sentence consists of a set of board cells,
     and a count of the number of those cells which are mines.
+
+    The sentence caches a frozenset of its cells, dropped whenever a cell
+    is marked, so it can be hashed without rebuilding the frozenset.
     """
 
     def __init__(self, cells, count):
         self.cells = set(cells)
         self.count = count
+        self.frozen_cells = cells if isinstance(cells, frozenset) else None
 
     def __eq__(self, other):
+        if not isinstance(other, Sentence):
+            return NotImplemented
         return self.cells == other.cells and self.count == other.count
 
+    def __hash__(self):
+        # Only stable while the sentence is not marked, so sets of
+        # sentences must be rebuilt after any call to mark_mine/mark_safe
+        return hash(self.key())
+
     def __str__(self):
         return f"{self.cells} = {self.count}"
 
+    def key(self):
+        """
+        Returns a hashable (frozenset(cells), count) snapshot of the sentence.
+        """
+        if self.frozen_cells is None:
+            self.frozen_cells = frozenset(self.cells)
+        return (self.frozen_cells, self.count)
+
     def known_mines(self):
         """
         Returns the set of all cells in self.cells known to be mines.
@@ -124,22 +150,30 @@ class Sentence():
         Updates internal knowledge representation given the fact that
         a cell is known to be a mine.
         """
-        cells = self.cells.copy()
-        for sentence_cell in cells:
-            if sentence_cell == cell:
-                self.cells.remove(cell)
-                self.count -= 1
-
+        if cell in self.cells:
+            self.cells.discard(cell)
+            self.count -= 1
+            self.frozen_cells = None
 
     def mark_safe(self, cell):
         """
         Updates internal knowledge representation given the fact that
         a cell is known to be safe.
         """
-        cells = self.cells.copy()
-        for sentence_cell in cells:
-            if sentence_cell == cell:
-                self.cells.remove(cell)
+        if cell in self.cells:
+            self.cells.discard(cell)
+            self.frozen_cells = None
+
+    def mark_safes(self, cells):
+        """
+        Updates internal knowledge representation given the fact that
+        every cell in the set `cells` is known to be safe.
+        """
+        removed = self.cells & cells
+        if not removed:
+            return
+        self.cells -= removed
+        self.frozen_cells = None
 
 class MinesweeperAI():
     """
@@ -159,26 +193,129 @@ class MinesweeperAI():
         self.mines = set()
         self.safes = set()
 
+        # Cells around every cell of the board
+        self.neighbors = neighbor_table(height, width)
+
         # List of sentences about the game known to be true
         self.knowledge = []
 
+        # Sentences that mention each unresolved cell, keyed by id(sentence)
+        self.cell_to_sentences = {}
+
+        # Ids of the sentences in the knowledge that are in the index
+        self.indexed = set()
+
+        # Keys of the sentences in the knowledge, to skip duplicates
+        self.sentence_keys = set()
+
+        # Sentences that changed and still have to be checked for inferences
+        self.dirty = deque()
+
+        # Every sentence and mark, as constraints for a SAT solver
+        self.sat = SatKnowledge(height, width)
+
+    def bit(self, cell):
+        """
+        Returns the bit representing `cell` in a board bitmask.
+        """
+        return 1 << (cell[0] * self.width + cell[1])
+
+    def mask(self, cells):
+        """
+        Returns the board bitmask with the bit of every cell in `cells` set.
+        """
+        mask = 0
+        for cell in cells:
+            mask |= self.bit(cell)
+        return mask
+
+    def add_sentence(self, sentence):
+        """
+        Adds a sentence to the knowledge, indexes it by its cells
+        and queues it to be checked for inferences.
+        """
+        self.knowledge.append(sentence)
+        self.index_sentence(sentence)
+
+    def index_sentence(self, sentence):
+        """
+        Applies the mines and safes already known to a sentence of the
+        knowledge, indexes it by its remaining cells and queues it to be
+        checked for inferences.
+        """
+        self.indexed.add(id(sentence))
+        for cell in sentence.cells & self.mines:
+            sentence.mark_mine(cell)
+        sentence.mark_safes(self.safes)
+        self.sentence_keys.add(sentence.key())
+        for cell in sentence.cells:
+            self.cell_to_sentences.setdefault(cell, {})[id(sentence)] = sentence
+        self.dirty.append(sentence)
+
+    def index_knowledge(self):
+        """
+        Indexes every sentence appended to self.knowledge directly
+        instead of through add_sentence, so marking and checking
+        the knowledge reach it as well.
+        """
+        if len(self.indexed) == len(self.knowledge):
+            return
+        present = set()
+        for sentence in self.knowledge:
+            if id(sentence) not in self.indexed:
+                self.index_sentence(sentence)
+            present.add(id(sentence))
+        self.indexed = present
+
     def mark_mine(self, cell):
         """
         Marks a cell as a mine, and updates all knowledge
         to mark that cell as a mine as well.
         """
-        self.mines.add(cell)
-        for sentence in self.knowledge:
+        self.index_knowledge()
+        if cell not in self.mines:
+            self.mines.add(cell)
+            self.sat.add_mine(cell)
+
+        # Only the sentences indexed under the cell can mention it
+        sentences = self.cell_to_sentences.pop(cell, None)
+        if sentences is None:
+            return
+        for sentence in sentences.values():
+            self.sentence_keys.discard(sentence.key())
             sentence.mark_mine(cell)
+            self.sentence_keys.add(sentence.key())
+            self.dirty.append(sentence)
 
     def mark_safe(self, cell):
         """
         Marks a cell as safe, and updates all knowledge
         to mark that cell as safe as well.
         """
-        self.safes.add(cell)
-        for sentence in self.knowledge:
-            sentence.mark_safe(cell)
+        self.mark_safes({cell})
+
+    def mark_safes(self, cells):
+        """
+        Marks every cell in the set `cells` as safe, and updates
+        each sentence that mentions any of them only once.
+        """
+        self.index_knowledge()
+        affected = {}
+        for cell in cells:
+            if cell not in self.safes:
+                self.safes.add(cell)
+                self.sat.add_safe(cell)
+
+            # Only the sentences indexed under the cell can mention it
+            sentences = self.cell_to_sentences.pop(cell, None)
+            if sentences is not None:
+                affected.update(sentences)
+
+        for sentence in affected.values():
+            self.sentence_keys.discard(sentence.key())
+            sentence.mark_safes(cells)
+            self.sentence_keys.add(sentence.key())
+            self.dirty.append(sentence)
 
     def add_knowledge(self, cell, count):
         """
@@ -204,96 +341,146 @@ class MinesweeperAI():
 
         # If no mines adjacent to the cell flipped
         if count == 0:
-            for i in range(cell[0] - 1, cell[0] + 2):
-                for j in range(cell[1] - 1, cell[1] + 2):
-                    # Ignore cell itself
-                    if (i, j) == cell:
-                        continue
-                    # If between bounds
-                    elif 0 <= i < self.height and 0 <= j < self.width:
-                        # If not already marked
-                        if (i, j) not in self.safes and (i, j) not in self.mines: # Add moves_made?
-                            # Mark as a safe cell
-                            self.mark_safe((i, j))
+            # Mark every neighbor not already marked as safe at once
+            self.mark_safes({
+                neighbor for neighbor in self.neighbors[cell]
+                if neighbor not in self.safes and neighbor not in self.mines
+            })
         else:
             new_knowledge_cells = set()
-            for i in range(cell[0] - 1, cell[0] + 2):
-                for j in range(cell[1] - 1, cell[1] + 2):
-                    # Ignore cell itself
-                    if (i, j) == cell:
-                        continue
-                    # Ignore if already marked as safe
-                    if (i, j) in self.safes:
-                        continue
-                    # Ignore and discount one mine if already marked as a mine
-                    if (i, j) in self.mines:
-                        count = count - 1
-                        continue
-                    # If between bounds
-                    if 0 <= i < self.height and 0 <= j < self.width:
-                        # Add cell to new list of cells
-                        new_knowledge_cells.add((i, j))
+            for neighbor in self.neighbors[cell]:
+                # Ignore if already marked as safe
+                if neighbor in self.safes:
+                    continue
+                # Ignore and discount one mine if already marked as a mine
+                if neighbor in self.mines:
+                    count = count - 1
+                    continue
+                # Add cell to new list of cells
+                new_knowledge_cells.add(neighbor)
             # Create a new sentence and add it to self.knowledge
-            print(f'Adding new knowledge: {Sentence(new_knowledge_cells, count)}')
-            self.knowledge.append(Sentence(new_knowledge_cells, count))
+            new_sentence = Sentence(new_knowledge_cells, count)
+            log.debug('Adding new knowledge: %s', new_sentence)
+            self.add_sentence(new_sentence)
+            self.sat.add_sentence(new_knowledge_cells, count)
 
         self.check_knowledge()
         # Check subsets
-        for i in range(len(self.knowledge)):
-            for j in range(len(self.knowledge)):
-                # Skip equal sentences
-                if self.knowledge[i] == self.knowledge[j]:
-                    continue
-                else:
-                    # If one is subset of another
-                    if self.knowledge[j].cells < self.knowledge[i].cells: 
-                        # Create new sentence
-                        new_cells = self.knowledge[i].cells - self.knowledge[j].cells
-                        new_count = self.knowledge[i].count - self.knowledge[j].count
-                        new_sentence = Sentence(new_cells, new_count)
-                        # If the new sentence is not already in the knowledge
-                        if new_sentence not in self.knowledge:
-                            # Add it to the knowledge
-                            print(f'Adding new inferred subset {new_sentence} made from {self.knowledge[i]} and {self.knowledge[j]}')
-                            self.knowledge.append(new_sentence)
+        self.infer_subsets()
         # Check knowledge
         self.check_knowledge()
+        # Only when there is no safe move left, mark the cells the
+        # sentences force but subsets could not find
+        if self.make_safe_move() is None:
+            self.infer_forced()
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Move made is %s = %s', cell, count)
+            log.debug('This is self.knowledge:')
+            for sentence in self.knowledge:
+                log.debug('%s', sentence)
+            log.debug('This is self.mines: %s', self.mines)
+            log.debug('This is self.safes: %s', self.safes)
+            log.debug('This is self.moves_made: %s', self.moves_made)
+            log.debug('-----------------------------------------------------------')
+
+    def infer_subsets(self):
+        """
+        Adds a sentence `A - B = countA - countB` for every pair of sentences
+        where B is a strict subset of A, unless it is already in the knowledge
+        """
 
-        print(f'Move made is {cell} = {count}')
-        print(f'This is self.knowledge:')
-        for sentence in self.knowledge:
-            print(sentence)
-        print(f'This is self.mines: {self.mines}')
-        print(f'This is self.safes: {self.safes}')
-        print(f'This is self.moves_made: {self.moves_made}')
-        print('-----------------------------------------------------------')
+        self.index_knowledge()
+
+        for big, small in self.subset_pairs():
+            new_cells = big.key()[0] - small.key()[0]
+            new_count = big.count - small.count
+            # Skip the sentence if it is already in the knowledge
+            if (new_cells, new_count) in self.sentence_keys:
+                continue
+            # Create new sentence and add it to the knowledge
+            new_sentence = Sentence(new_cells, new_count)
+            log.debug('Adding new inferred subset %s made from %s and %s', new_sentence, big, small)
+            self.add_sentence(new_sentence)
+
+    def subset_pairs(self):
+        """
+        Returns a list of (big, small) pairs of sentences in the knowledge
+        where the cells of small are a strict subset of the cells of big.
+        """
+
+        # Masks of boards up to 64 cells fit in a uint64, so the pairs
+        # come from the compiled kernel in a single pass over the masks
+        if self.height * self.width <= 64:
+            knowledge = self.knowledge
+            masks = np.array([self.mask(sentence.cells) for sentence in knowledge], dtype=np.uint64)
+            return [(knowledge[i], knowledge[j]) for i, j in strict_subset_pairs(masks)]
+
+        # Larger boards find the supersets of each sentence through the cell index
+        pairs = []
+        for small in self.knowledge:
+            # Every sentence that contains all cells of the small one
+            entries = sorted((self.cell_to_sentences[cell] for cell in small.cells), key=len)
+            candidates = set(entries[0]).intersection(*entries[1:])
+            for sentence_id in candidates:
+                big = entries[0][sentence_id]
+                # Skip the sentence itself, the only candidate of the same size
+                if len(big.cells) != len(small.cells):
+                    pairs.append((big, small))
+        return pairs
+
+    def infer_forced(self):
+        """
+        Asks the SAT solver which of the cells still mentioned by a sentence
+        must be a mine or must be safe, marks them and checks the knowledge again
+        """
+
+        self.index_knowledge()
+
+        for cell, is_mine in self.sat.forced(list(self.cell_to_sentences)):
+            log.debug('SAT inferred %s is a %s', cell, 'mine' if is_mine else 'safe')
+            if is_mine:
+                self.mark_mine(cell)
+            else:
+                self.mark_safe(cell)
+        self.check_knowledge()
 
     def check_knowledge(self):
         """
         Checks the knowledge to see if any safes or mines can be inferred and simplified from
-        existing sentences. If found any, the loop re-starts
-        """
-      
-        # Make a copy to loop over and make changes
-        knowledge = self.knowledge.copy()
-        for sentence in knowledge:
-            # Delete empty sentences
-            if len(sentence.cells) == 0:
-                self.knowledge.remove(sentence)
-                return self.check_knowledge()
+        existing sentences. Only sentences queued in self.dirty are checked, and marking
+        a cell queues every sentence that mentions it, so the loop runs until nothing changes
+        """
+
+        # Sentences appended to self.knowledge directly are indexed and queued first
+        self.index_knowledge()
+
+        while self.dirty:
+            sentence = self.dirty.popleft()
+            mines = sentence.known_mines()
             # If sentence has only mines
-            if sentence.known_mines():
+            if mines:
                 # Mark every cell as a mine
-                for sentence_cell in sentence.known_mines():
+                for sentence_cell in mines:
                     self.mark_mine(sentence_cell)
-                return self.check_knowledge()
+                continue
+            safes = sentence.known_safes()
             # If sentence has only safes
-            if sentence.known_safes():
+            if safes:
                 # Mark every cell as safe
-                for sentence_cell in sentence.known_safes():
-                    self.mark_safe(sentence_cell)
-                return self.check_knowledge()
-        
+                self.mark_safes(safes)
+
+        # Delete empty sentences in place, moving the last sentence into each hole
+        knowledge = self.knowledge
+        i = 0
+        while i < len(knowledge):
+            if knowledge[i].cells:
+                i += 1
+                continue
+            self.indexed.discard(id(knowledge[i]))
+            knowledge[i] = knowledge[-1]
+            knowledge.pop()
+
     def make_safe_move(self):
         """
         Returns a safe cell to choose on the Minesweeper board.
@@ -303,8 +490,9 @@ class MinesweeperAI():
         This function may use the knowledge in self.mines, self.safes
         and self.moves_made, but should not modify any of those values.
         """
-        for cell in self.safes:
-            if cell not in self.moves_made and cell not in self.mines:
+        # Set difference runs in C, so only the unused safes are scanned in Python
+        for cell in self.safes - self.moves_made:
+            if cell not in self.mines:
                 return cell
         return None
 
@@ -315,12 +503,15 @@ class MinesweeperAI():
             1) have not already been chosen, and
             2) are not known to be mines
         """
-        possibilities = []
-        for i in range(self.height):
-            for j in range(self.width):
-                if (i, j) not in self.moves_made and (i, j) not in self.safes and (i, j) not in self.mines:
-                    possibilities.append((i, j))
-        if len(possibilities) == 0:
+        # Bitmask of every cell that is a move made or known to be safe or a mine
+        taken = self.mask(itertools.chain(self.moves_made, self.safes, self.mines))
+        board = (1 << (self.height * self.width)) - 1
+        free = board & ~taken
+        if not free:
             return None
-        else:
-            return random.choice(possibilities)
+
+        # Clear a random number of the lowest set bits and take the next one
+        for _ in range(random.randrange(free.bit_count())):
+            free &= free - 1
+        k = (free & -free).bit_length() - 1
+        return (k // self.width, k % self.width)